@@ -1,11 +1,11 @@
+import asyncio
 import logging
 import os
-import json
-import requests
+import orjson
+import httpx
 import azure.functions as func
 import re
-import traceback
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
 logging.basicConfig(level=logging.INFO)
 app = func.FunctionApp()
@@ -18,9 +18,66 @@ REQUIRED_ENV_VARS = [
     "SEARCH_KEY"
 ]
 
+# App settings are fixed for the lifetime of the worker, so resolve them once
+_ENV = {key: os.environ.get(key) for key in REQUIRED_ENV_VARS}
+_MISSING_ENV = [key for key, value in _ENV.items() if not value]
+
+_AI_HEADERS = {
+    "api-key": _ENV["AI_FOUND_API_KEY"],
+    "Content-Type": "application/json"
+}
+
+# The search data source never changes per request, so it is built once
+_DATA_SOURCES = [
+    {
+        "type": "azure_search",
+        "parameters": {
+            "endpoint": _ENV["SEARCH_ENDPOINT"],
+            "index_name": _ENV["SEARCH_INDEX_NAME"],
+            "semantic_configuration": "rag-dennemeyer-semantic-configuration",
+            "query_type": "semantic",
+            "fields_mapping": {},
+            "in_scope": True,
+            "filter": None,
+            "strictness": 3,
+            "top_n_documents": 5,
+            "authentication": {
+                "type": "api_key",
+                "key": _ENV["SEARCH_KEY"]
+            }
+        }
+    }
+]
+
+# Only the most recent chat history messages are kept; the model's context
+# window could not use an unbounded history anyway
+MAX_HISTORY = 40
+
 # Hardcoded URL for the single document
 HARDCODED_DOCUMENT_URL = ""
 
+# Shared async client so warm invocations reuse pooled keep-alive connections
+# and concurrent requests multiplex over HTTP/2. No client timeout: long
+# completions are normal and the function timeout bounds the wait.
+_HTTPX = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=64),
+    timeout=None
+)
+
+# Throttled or unavailable AI service responses are retried with backoff
+_RETRY_STATUSES = frozenset({429, 503})
+_MAX_RETRIES = 2
+_RETRY_BACKOFF = 0.2
+
+# Canned greeting reply, built once rather than per greeting request
+_GREETINGS = frozenset({"hello", "hi", "hey", "greetings"})
+_GREETING_ANSWER = "Hello! How can I assist you with the WIPO Patent Drafting Manual or patent-related questions today?"
+_GREETING_ASSISTANT_MSG = {"role": "assistant", "content": _GREETING_ANSWER}
+
+# Citation patterns used on every response
+_CITE_RE = re.compile(r'\[(\d+)\]')
+
 def load_system_prompt(path="system_prompt.md") -> str:
     try:
         if not os.path.isabs(path):
@@ -31,106 +88,139 @@ def load_system_prompt(path="system_prompt.md") -> str:
         logging.error(f"System prompt file not found at {path}")
         return "System prompt file not found."
 
-def remove_orphan_citations(text: str, valid_numbers: set) -> str:
-    return re.sub(r'\[(\d+)\]', lambda m: f"[{m.group(1)}]" if m.group(1) in valid_numbers else "", text)
+# Read once per worker; warm invocations reuse the same system message
+_SYSTEM_PROMPT_MSG = {
+    "role": "system",
+    "content": load_system_prompt()
+}
+
+def _sanitize_history(chat_history) -> List[Dict]:
+    """
+    Keep only the role and content of the last MAX_HISTORY history messages.
+    History that is already in that shape is returned as is instead of being rebuilt.
+    """
+    if isinstance(chat_history, list):
+        if len(chat_history) > MAX_HISTORY:
+            chat_history = chat_history[-MAX_HISTORY:]
+        for msg in chat_history:
+            if not (isinstance(msg, dict) and len(msg) == 2 and "role" in msg and "content" in msg):
+                break
+        else:
+            return chat_history
+    return [
+        {"role": msg["role"], "content": msg["content"]}
+        for msg in chat_history
+        if isinstance(msg, dict) and "role" in msg and "content" in msg
+    ]
+
+def _doc_key(doc: Dict) -> str:
+    return (doc.get("url") or "").lower() or doc.get("title", "").lower() or "wipo-patent-drafting-manual"
+
+def _map_citation_numbers(keys: List[str], doc_key_map: Dict[str, int]) -> Dict[str, str]:
+    """
+    Map each original citation number (1-based, as text) to the number of its
+    deduplicated document.
+    """
+    orig_to_unique = {}
+    for idx, key in enumerate(keys):
+        if key in doc_key_map:
+            orig_to_unique[str(idx + 1)] = str(doc_key_map[key])
+    return orig_to_unique
+
+def _rewrite_citations(text: str, orig_to_unique: Dict[str, str], valid_numbers: set) -> Tuple[str, set]:
+    """
+    Renumber citations, drop orphans and separate joined citations like [1][2]
+    in a single pass. Returns the rewritten text and the citation numbers kept, as ints.
+    """
+    parts = []
+    used_refs = set()
+    last = 0
+    after_citation = False
+    for m in _CITE_RE.finditer(text):
+        if m.start() > last:
+            parts.append(text[last:m.start()])
+            after_citation = False
+        last = m.end()
+        orig = m.group(1)
+        num = orig_to_unique.get(orig, orig)
+        if num not in valid_numbers:
+            continue
+        if after_citation:
+            parts.append(", ")
+        parts.append(f"[{num}]")
+        used_refs.add(int(num))
+        after_citation = True
+    parts.append(text[last:])
+    return "".join(parts), used_refs
+
+async def _post_to_ai_service(body: bytes) -> httpx.Response:
+    """
+    POST a chat completion request, retrying throttled or unavailable responses.
+    The last response is returned either way so callers can report its status.
+
+    Each call carries exactly one conversation. The chat completions endpoint
+    has no multi-conversation batch form ("n" only samples more choices for
+    the same messages), so concurrent requests overlap on the async client
+    instead of being batched into one upstream call.
+    """
+    for attempt in range(_MAX_RETRIES + 1):
+        response = await _HTTPX.post(_ENV["AI_FOUND_ENDPOINT"], headers=_AI_HEADERS, content=body)
+        if response.status_code not in _RETRY_STATUSES or attempt == _MAX_RETRIES:
+            return response
+        await asyncio.sleep(_RETRY_BACKOFF * 2 ** attempt)
 
 @app.function_name(name="HttpAskAI")
 @app.route(route="ask-ai", auth_level=func.AuthLevel.FUNCTION)
-def ask_ai(req: func.HttpRequest) -> func.HttpResponse:
+async def ask_ai(req: func.HttpRequest) -> func.HttpResponse:
     try:
-        req_body = req.get_json()
+        req_body = orjson.loads(req.get_body())
         message = req_body.get("message")
         chat_history = req_body.get("history", [])
 
         if not message:
             return _error_response("Missing 'message' in request body", 400)
 
-        # Check for missing environment variables
-        missing = [key for key in REQUIRED_ENV_VARS if not os.getenv(key)]
-        if missing:
-            return _error_response(f"Missing environment variable(s): {missing}", 500)
-
         # Sanitize chat_history to remove 'id' fields
-        sanitized_history = [
-            {"role": msg["role"], "content": msg["content"]}
-            for msg in chat_history
-            if isinstance(msg, dict) and "role" in msg and "content" in msg
-        ]
-
-        system_message = {
-            "role": "system",
-            "content": load_system_prompt()
-        }
+        sanitized_history = _sanitize_history(chat_history)
 
-        messages = [system_message] + sanitized_history + [{"role": "user", "content": message}]
+        # Greetings are answered locally and never reach the AI service
+        if message.strip().lower() in _GREETINGS:
+            return _greeting_response(message, sanitized_history)
 
-        # Greeting detection before AI call and fallback
-        greetings = {"hello", "hi", "hey", "greetings"}
-        if message and message.strip().lower() in greetings:
-            return func.HttpResponse(
-                json.dumps({
-                    "answer": "Hello! How can I assist you with the WIPO Patent Drafting Manual or patent-related questions today?",
-                    "history": sanitized_history + [
-                        {"role": "user", "content": message},
-                        {"role": "assistant", "content": "Hello! How can I assist you with the WIPO Patent Drafting Manual or patent-related questions today?"}
-                    ],
-                    "references": []
-                }),
-                status_code=200,
-                mimetype="application/json"
-            )
+        # Check for missing environment variables
+        if _MISSING_ENV:
+            return _error_response(f"Missing environment variable(s): {_MISSING_ENV}", 500)
+
+        # messages is its own list, so each branch below can extend sanitized_history in place
+        user_message = {"role": "user", "content": message}
+        messages = [_SYSTEM_PROMPT_MSG, *sanitized_history, user_message]
 
-        ai_response = requests.post(
-            os.environ["AI_FOUND_ENDPOINT"],
-            headers={
-                "api-key": os.environ["AI_FOUND_API_KEY"],
-                "Content-Type": "application/json"
-            },
-            json={
+        ai_response = await _post_to_ai_service(
+            orjson.dumps({
                 "messages": messages,
                 "temperature": 0.2,
                 "top_p": 1.0,
-                "data_sources": [
-                    {
-                        "type": "azure_search",
-                        "parameters": {
-                            "endpoint": os.environ["SEARCH_ENDPOINT"],
-                            "index_name": os.environ["SEARCH_INDEX_NAME"],
-                            "semantic_configuration": "rag-dennemeyer-semantic-configuration",
-                            "query_type": "semantic",
-                            "fields_mapping": {},
-                            "in_scope": True,
-                            "filter": None,
-                            "strictness": 3,
-                            "top_n_documents": 5,
-                            "authentication": {
-                                "type": "api_key",
-                                "key": os.environ["SEARCH_KEY"]
-                            }
-                        }
-                    }
-                ]
-            }
+                "data_sources": _DATA_SOURCES
+            })
         )
 
         if ai_response.status_code != 200:
-            logging.error(f"AI service request failed with status {ai_response.status_code}: {ai_response.text}")
-            return _error_response("AI service request failed", ai_response.status_code, extra={"message": ai_response.text})
+            error_text = ai_response.text
+            logging.error(f"AI service request failed with status {ai_response.status_code}: {error_text}")
+            return _error_response("AI service request failed", ai_response.status_code, extra={"message": error_text})
 
-        result = ai_response.json()
-        assistant_reply = result["choices"][0]["message"]["content"]
-        citations = result["choices"][0]["message"].get("context", {}).get("citations", [])
+        # Parse the raw body once; the reply text is only needed past the fallbacks
+        reply_message = orjson.loads(ai_response.content)["choices"][0]["message"]
 
         # Fallback: check confidence score
-        confidence = result["choices"][0]["message"].get("confidence", 1.0)
+        confidence = reply_message.get("confidence", 1.0)
         if confidence < 0.5:
+            sanitized_history.append(user_message)
+            sanitized_history.append({"role": "assistant", "content": "I'm not confident in the answer. Please refine or rephrase your question for better results."})
             return func.HttpResponse(
-                json.dumps({
+                orjson.dumps({
                     "answer": "I'm not confident in the answer. Please refine or rephrase your question for better results.",
-                    "history": sanitized_history + [
-                        {"role": "user", "content": message},
-                        {"role": "assistant", "content": "I'm not confident in the answer. Please refine or rephrase your question for better results."}
-                    ],
+                    "history": sanitized_history,
                     "references": []
                 }),
                 status_code=200,
@@ -138,82 +228,67 @@ def ask_ai(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         # Fallback: no citations/retrievals
+        citations = reply_message.get("context", {}).get("citations", [])
         if not citations:
+            sanitized_history.append(user_message)
+            sanitized_history.append({"role": "assistant", "content": "No relevant information was found. Please contact sulaiman@test.com for further assistance."})
             return func.HttpResponse(
-                json.dumps({
+                orjson.dumps({
                     "answer": "No relevant information was found. Please contact sulaiman@test.com for further assistance.",
-                    "history": sanitized_history + [
-                        {"role": "user", "content": message},
-                        {"role": "assistant", "content": "No relevant information was found. Please contact sulaiman@test.com for further assistance."}
-                    ],
+                    "history": sanitized_history,
                     "references": []
                 }),
                 status_code=200,
                 mimetype="application/json"
             )
 
-        # Log citations for debugging
-        logging.debug(f"Citations received: {json.dumps(citations, indent=2)}")
+        assistant_reply = reply_message["content"]
+
+        # Log citations for debugging; skip the dump entirely unless debug logging is on
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"Citations received: {_pretty_json(citations)}")
 
         # Deduplicate citations by document (prefer URL, fallback to title)
         unique_docs = []
         doc_key_map = {}  # Maps doc key to its assigned citation number
 
-        def doc_key(doc):
-            return (doc.get("url") or "").lower() or doc.get("title", "").lower() or "wipo-patent-drafting-manual"
-
-        for doc in citations:
-            key = doc_key(doc)
-            if key and key not in doc_key_map:
-                doc_key_map[key] = len(unique_docs) + 1  # Citation number starts at 1
+        keys = [_doc_key(doc) for doc in citations]
+        for doc, key in zip(citations, keys):
+            # setdefault hands back the existing number for a seen key, so only new keys exceed the count
+            if key and doc_key_map.setdefault(key, len(unique_docs) + 1) > len(unique_docs):  # Citation number starts at 1
                 unique_docs.append(doc)
 
-        # Replace citations in the answer text with unique numbers
-        def replace_citations(text, citations):
-            orig_to_unique = {}
-            for idx, doc in enumerate(citations):
-                key = doc_key(doc)
-                if key in doc_key_map:
-                    orig_to_unique[str(idx + 1)] = str(doc_key_map[key])
-            def repl(m):
-                orig = m.group(1)
-                return f"[{orig_to_unique.get(orig, orig)}]"
-            return re.sub(r'\[(\d+)\]', repl, text)
-
-        assistant_reply = replace_citations(assistant_reply, citations)
+        # Map the model's citation numbers onto the unique numbers
+        orig_to_unique = _map_citation_numbers(keys, doc_key_map)
 
         # Build references array with hardcoded URL and page numbers
         references = []
         for i, doc in enumerate(unique_docs):
             index = i + 1
             title = doc.get("title", "WIPO Patent Drafting Manual")
-            # Try multiple field names for page number
-            page = doc.get("page") or doc.get("pageNumber") or doc.get("chunk_id")
-            url = HARDCODED_DOCUMENT_URL
-            if page and isinstance(page, (int, str)) and str(page).isdigit():
-                url = f"{HARDCODED_DOCUMENT_URL}#page={page}"
-            else:
-                logging.warning(f"No valid page number found for citation {index}: {json.dumps(doc, indent=2)}")
+            # Resolved once here; the reference links below reuse it
+            url = _generate_blob_url(doc)
+            if url == HARDCODED_DOCUMENT_URL:
+                logging.warning(f"No valid page number found for citation {index}: {_pretty_json(doc)}")
             references.append({
                 "index": index,
                 "title": title,
                 "url": url
             })
 
-        # Remove orphan citations after building references
+        # Renumber citations and remove orphans in one pass over the reply
         valid_citation_numbers = {str(ref["index"]) for ref in references}
-        assistant_reply = remove_orphan_citations(assistant_reply, valid_citation_numbers)
+        assistant_reply, used_refs = _rewrite_citations(assistant_reply, orig_to_unique, valid_citation_numbers)
 
         # Append reference links to the reply
-        assistant_reply = _append_reference_links(assistant_reply, unique_docs)
+        assistant_reply = _append_reference_links(assistant_reply, references, used_refs)
 
+        sanitized_history.append(user_message)
+        sanitized_history.append({"role": "assistant", "content": assistant_reply})
         return func.HttpResponse(
-            json.dumps({
+            orjson.dumps({
                 "answer": assistant_reply,
-                "history": sanitized_history + [
-                    {"role": "user", "content": message},
-                    {"role": "assistant", "content": assistant_reply}
-                ],
+                "history": sanitized_history,
                 "references": references
             }),
             status_code=200,
@@ -222,51 +297,64 @@ def ask_ai(req: func.HttpRequest) -> func.HttpResponse:
 
     except Exception as e:
         logging.exception("❌ Unhandled exception in ask_ai")
-        return _error_response("Unhandled exception", 500, extra={
-            "message": str(e),
-            "trace": traceback.format_exc()
-        })
+        return _error_response("Unhandled exception", 500, extra={"message": str(e)})
 
 def _generate_blob_url(doc: Dict) -> str:
     """
     Return the hardcoded document URL with an optional page number fragment.
+    Tries multiple field names for the page number.
     """
     page = doc.get("page") or doc.get("pageNumber") or doc.get("chunk_id")
-    if page and isinstance(page, (int, str)) and str(page).isdigit():
+    # bool is an int subclass but never a page number
+    if isinstance(page, int) and not isinstance(page, bool) and page > 0:
+        return f"{HARDCODED_DOCUMENT_URL}#page={page}"
+    if isinstance(page, str) and page.isdigit():
         return f"{HARDCODED_DOCUMENT_URL}#page={page}"
     return HARDCODED_DOCUMENT_URL
 
-def _append_reference_links(answer: str, docs: List[Dict]) -> str:
-    if not docs or not isinstance(docs, list):
+def _append_reference_links(answer: str, references: List[Dict], used_refs: set) -> str:
+    if not references or not isinstance(references, list):
         return answer
 
-    # Fix joined citations like [1][2] and [1][2][3]
-    answer = re.sub(r'\[(\d+)\]\[(\d+)\]', r'[\1], [\2]', answer)
-    answer = re.sub(r'(\[\d+\])(?=\[\d+\])', r'\1, ', answer)
-
-    # Extract used reference numbers
-    used_refs = set(re.findall(r'\[(\d+)\]', answer))
-
-    references_section = ""
-    for ref in sorted(used_refs, key=lambda x: int(x)):
-        idx = int(ref) - 1
-        if 0 <= idx < len(docs):
-            doc = docs[idx]
-            url = _generate_blob_url(doc)
-            references_section += f"[{ref}]: {url}\n"
+    lines = []
+    for ref in sorted(used_refs):
+        idx = ref - 1
+        if 0 <= idx < len(references):
+            url = references[idx]["url"]
+            lines.append(f"[{ref}]: {url}")
             logging.debug(f"🔗 Citation [{ref}] → {url}")
         else:
-            references_section += f"[{ref}]: #\n"
+            lines.append(f"[{ref}]: #")
             logging.warning(f"⚠️ Reference index [{ref}] out of bounds")
 
-    return answer.strip() + "\n\n" + references_section.strip() + "\n"
+    references_section = "\n".join(lines).strip()
+    return f"{answer.strip()}\n\n{references_section}\n"
+
+def _pretty_json(value) -> str:
+    """
+    Indented JSON for log messages only.
+    """
+    return orjson.dumps(value, option=orjson.OPT_INDENT_2).decode()
 
 def _error_response(message: str, status_code: int, extra: dict = None) -> func.HttpResponse:
     payload = {"error": message}
     if extra:
         payload.update(extra)
     return func.HttpResponse(
-        json.dumps(payload),
+        orjson.dumps(payload),
         status_code=status_code,
         mimetype="application/json"
+    )
+
+def _greeting_response(message: str, history: List[Dict]) -> func.HttpResponse:
+    history.append({"role": "user", "content": message})
+    history.append(_GREETING_ASSISTANT_MSG)
+    return func.HttpResponse(
+        orjson.dumps({
+            "answer": _GREETING_ANSWER,
+            "history": history,
+            "references": []
+        }),
+        status_code=200,
+        mimetype="application/json"
     )
\ No newline at end of file